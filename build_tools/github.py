@@ -46,9 +46,17 @@ def _create_headers(headers, token):
     headers["X-GitHub-Api-Version"] = "2022-11-28"
     return headers
 
+_session = None
+def _get_session():
+    # Reuse one keep-alive connection pool for all API calls
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
 # use GraphQL API
 def query(query, token, headers = None):
-    import requests
     try:
         url = URL_GRAPHQL_API
         if query.startswith("query"):
@@ -56,7 +64,7 @@ def query(query, token, headers = None):
         else:
             json = { 'query': "query " + query }
         headers = _create_headers(headers, token)
-        response = requests.post(url, json = json, headers = headers)
+        response = _get_session().post(url, json = json, headers = headers)
         response.raise_for_status()
         return response.json()
     except Exception as err:
@@ -64,10 +72,9 @@ def query(query, token, headers = None):
         return None
 
 def get(url, token, headers = None):
-    import requests
     try:
         headers = _create_headers(headers, token)
-        response = requests.get(_fix_url(url), headers=headers)
+        response = _get_session().get(_fix_url(url), headers=headers)
         response.raise_for_status()
         return response.json()
     except Exception as err:
@@ -75,10 +82,9 @@ def get(url, token, headers = None):
         return None
 
 def post(url, token, data = None, json = None, files = None, headers = None):
-    import requests
     try:
         headers = _create_headers(headers, token)
-        response = requests.post(_fix_url(url), data = data, json = json, files = files, headers = headers)
+        response = _get_session().post(_fix_url(url), data = data, json = json, files = files, headers = headers)
         response.raise_for_status()
         return response.json()
     except Exception as err:
@@ -86,10 +92,9 @@ def post(url, token, data = None, json = None, files = None, headers = None):
         return None
 
 def put(url, token, data = None, json = None, headers = None):
-    import requests
     try:
         headers = _create_headers(headers, token)
-        response = requests.put(_fix_url(url), data = data, json = json, headers = headers)
+        response = _get_session().put(_fix_url(url), data = data, json = json, headers = headers)
         response.raise_for_status()
         return response.json()
     except Exception as err:
@@ -97,10 +102,9 @@ def put(url, token, data = None, json = None, headers = None):
         return None
 
 def patch(url, token, data = None, json = None, headers = None):
-    import requests
     try:
         headers = _create_headers(headers, token)
-        response = requests.patch(_fix_url(url), data = data, json = json, headers = headers)
+        response = _get_session().patch(_fix_url(url), data = data, json = json, headers = headers)
         response.raise_for_status()
         return response.json()
     except Exception as err:
@@ -108,10 +112,9 @@ def patch(url, token, data = None, json = None, headers = None):
         return None
 
 def delete(url, token, headers = None):
-    import requests
     try:
         headers = _create_headers(headers, token)
-        response = requests.delete(_fix_url(url), headers = headers)
+        response = _get_session().delete(_fix_url(url), headers = headers)
         response.raise_for_status()
         if response.content and response.content != "":
             return response.json()
@@ -12,10 +12,34 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-import sys, os, os.path, glob, urllib, urllib.request, codecs, time, hashlib
+import sys, os, os.path, mmap, shutil, threading, socket, random, urllib, urllib.request, time, hashlib, sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlparse
 
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+# Files at least this large are fetched as several concurrent range requests
+# when the server supports it
+PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+PARALLEL_PARTS = 4
+
+# Algorithm of the digests kept in the cache index, see _new_hash()
+DIGEST_ALGO = 'blake2b'
+
+# HTTP status codes that won't change by retrying
+PERMANENT_HTTP_ERRORS = {400, 401, 403, 404, 410, 501}
+
+# Connections shared by all downloads of the process, when urllib3 is available.
+# Retries are handled by download() itself, so only redirects are followed here.
+_POOL = None
+if urllib3 is not None:
+    _POOL = urllib3.PoolManager(num_pools=4, maxsize=8,
+                                retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5))
+
 def mangle(url):
     url = urlparse(url)
     return 'defold%s' % url.path.replace('/', '-') # we avoid putting the possibly secret url in the output messages
@@ -25,74 +49,295 @@ def log(msg):
     sys.stdout.flush()
     sys.stderr.flush()
 
+class LRUIndex(object):
+    """
+    Small SQLite index of the cache contents, keyed on the mangled url.
+    Replaces the old scheme of encoding the etag in the file name and
+    globbing the cache directory on every lookup.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=60)
+        self.created = self.db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='kv'").fetchone() is None
+        self.db.execute('CREATE TABLE IF NOT EXISTS kv (url TEXT PRIMARY KEY, file TEXT, etag TEXT, size INTEGER, atime REAL, digest TEXT)')
+
+    def get(self, url):
+        row = self.db.execute('SELECT file, etag, size, digest FROM kv WHERE url=?', (url,)).fetchone()
+        if row:
+            self.db.execute('UPDATE kv SET atime=? WHERE url=?', (time.time(), url))
+        return row
+
+    def put(self, url, file, etag, size, atime=None, digest=None):
+        self.db.execute('INSERT OR REPLACE INTO kv (url, file, etag, size, atime, digest) VALUES (?, ?, ?, ?, ?, ?)',
+                        (url, file, etag, size, atime or time.time(), digest))
+
+    def remove(self, url):
+        """
+        Drop the entry for url. Returns the file it pointed to, or None if there was no entry.
+        """
+        row = self.db.execute('SELECT file FROM kv WHERE url=?', (url,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM kv WHERE url=?', (url,))
+        return row[0] if row else None
+
+    def evict(self, max_size):
+        """
+        Drop the least recently used entries until the remaining ones fit in max_size.
+        Returns the files of the evicted entries.
+        """
+        rows = self.db.execute('SELECT url, file FROM (SELECT url, file, SUM(size) OVER (ORDER BY atime DESC) AS total FROM kv) WHERE total > ?',
+                               (max_size,)).fetchall()
+        if rows:
+            self.db.executemany('DELETE FROM kv WHERE url=?', [(url,) for url, _ in rows])
+        return [file for _, file in rows]
+
 class Cache(object):
+    INDEX_NAME = 'index.db'
+
     def __init__(self, root, max_size):
         self.root = os.path.expanduser(root)
         if not os.path.exists(self.root):
             os.makedirs(self.root)
         self.max_size = max_size
+        self.index = LRUIndex(os.path.join(self.root, self.INDEX_NAME))
+        if self.index.created:
+            self._import_legacy_entries()
+
+    def _import_legacy_entries(self):
+        """
+        Add the files from the previous cache layout, where the etag was hex encoded
+        as a suffix of the file name (defold-<mangled>-<etag hex>), to a new index.
+        """
+        for entry in os.scandir(self.root):
+            if not entry.name.startswith('defold-') or not entry.is_file():
+                continue
+            try:
+                if entry.name.endswith('_tmp'):
+                    os.remove(entry.path)
+                    continue
+                key, _, key_hex = entry.name.rpartition('-')
+                etag = bytes.fromhex(key_hex).rstrip(b'\0').decode('utf-8')
+                st = entry.stat() # cached on the DirEntry, free on Windows
+                self.index.put(key, entry.path, etag, st.st_size, st.st_mtime)
+            except ValueError:
+                pass # not a file from the old layout
+            except Exception as e:
+                log(str(e))
 
     def _url_to_path(self, url):
         return os.path.join(self.root, mangle(url))
 
     def get(self, url):
-        path = self._url_to_path(url)
-        pattern = '%s-*' % (path)
-        matches = glob.glob(pattern)
-        if matches:
-            match = matches[0]
-            if match.endswith('_tmp'):
-                # remove stale tmp and treat as miss
-                try: os.remove(match)
-                except: pass
-                return None
-            key_hex = match.rsplit('-', 1)[1]
-            os.utime(match, None)
-            try:
-                return (match, codecs.decode(key_hex, 'hex'))
-            except Exception:
-                # malformed key -> still return file but no key
-                return (match, b'')
-        return None
+        key = mangle(url)
+        row = self.index.get(key)
+        if not row:
+            return None
+        path, etag, size, digest = row
+        if not os.path.isfile(path):
+            # entry without a (completed) file -> treat as miss
+            self.index.remove(key)
+            return None
+        return (path, (etag or '').encode('utf-8'), size, digest)
+
+    def validate(self, url, hit):
+        """
+        Check the file of a hit from get() against the size and digest recorded when it was downloaded.
+        A file that doesn't match is removed from the cache.
+        """
+        path, _, size, digest = hit
+        # Entries from the old layout have no digest, and size 0 may mean the size wasn't known
+        if _validate_file(path, size or None, digest, DIGEST_ALGO) and os.path.getsize(path) > 0:
+            return True
+        self.index.remove(mangle(url))
+        try:
+            os.remove(path)
+        except Exception as e:
+            log(str(e))
+        return False
 
     def _accomodate(self, size):
-        matches = glob.glob('%s/*' % (self.root))
-        matches.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-        total_size = 0
-        for p in matches:
+        for p in self.index.evict(self.max_size - size):
             try:
-                total_size += os.path.getsize(p)
-                if total_size + size > self.max_size:
+                if os.path.exists(p):
                     os.remove(p)
             except Exception as e:
                 log(str(e))
 
-    def put(self, url, key, size):
+    def put(self, url, key, size, digest=None):
         path = self._url_to_path(url)
-        pattern = '%s-*' % (path)
-        for p in glob.glob(pattern):
-            try: os.remove(p)
+        prev = self.index.remove(mangle(url))
+        if prev and os.path.exists(prev):
+            try: os.remove(prev)
             except Exception as e: log(str(e))
         self._accomodate(size)
-        key_enc = codecs.encode((key or "").encode(), 'hex').decode('ascii')
-        return '%s-%s' % (path, key_enc or '00')  # ensure a suffix
+        self.index.put(mangle(url), path, key or '', size, digest=digest)
+        return path
+
+class CallbackWriter(object):
+    """
+    File-like sink for shutil.copyfileobj that writes to f, keeps a byte count,
+    feeds the hash objects and reports progress through cb.
+    f may be None to only count and report.
+    """
+    def __init__(self, f, n=0, hashes=(), cb=None, expected_size=None, cb_count=10):
+        self.f = f
+        self.n = n
+        self.hashes = hashes
+        self.cb = cb
+        self.expected_size = expected_size
+        if expected_size:
+            # report every expected_size/cb_count bytes, starting at the first write (0%)
+            self.step = max(expected_size // cb_count, 1)
+            self.next_trigger = 0
+        else:
+            # Unknown length: report every MiB, with total=None
+            self.expected_size = None
+            self.step = 1024 * 1024
+            self.next_trigger = self.step
+
+    def write(self, buf):
+        if self.f is not None:
+            self.f.write(buf)
+        self.n += len(buf)
+        for h in self.hashes:
+            h.update(buf)
+        if self.cb is not None and self.n >= self.next_trigger:
+            self.next_trigger = (self.n // self.step + 1) * self.step
+            self.cb(self.n, self.expected_size)
+        return len(buf)
+
+class PooledResponse(object):
+    """
+    Wraps a urllib3 response in the parts of the urllib response interface that download() uses.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.code = response.status
+        self.headers = response.headers
+        self.done = False
+
+    def getcode(self):
+        return self.code
 
-def _validate_file(path, expected_size=None, expected_md5=None):
+    def read(self, amt=None):
+        buf = self.response.read(amt)
+        if not buf:
+            self.done = True
+        return buf
+
+    def close(self):
+        if not self.done:
+            # don't drain the rest of the body just to reuse the connection
+            self.response.close()
+        self.response.release_conn()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _urlopen(url, headers, timeout):
+    """
+    GET url, reusing pooled connections when possible.
+    Like urllib.request.urlopen(), raises HTTPError for non 2xx responses.
+    """
+    # urllib3 doesn't pick up proxies from the environment, leave those to urllib
+    if _POOL is None or urllib.request.getproxies():
+        return urllib.request.urlopen(urllib.request.Request(url, None, headers), timeout=timeout)
+    try:
+        response = _POOL.request('GET', url, headers=headers, timeout=timeout, preload_content=False, decode_content=False)
+    except urllib3.exceptions.MaxRetryError as e:
+        reason = e.reason
+        if isinstance(reason.__cause__, socket.gaierror):
+            reason = reason.__cause__ # lets download() tell unknown hosts apart
+        raise URLError(reason)
+    if not 200 <= response.status < 300:
+        response.release_conn()
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    return PooledResponse(response)
+
+def _new_hash(hash_algo='md5'):
+    """
+    Create a hash object for integrity checks (not security).
+    - hash_algo: 'md5' to match checksums sent by servers, or 'blake2b' which is considerably faster
+    """
+    if hash_algo == 'blake2b':
+        return hashlib.blake2b(digest_size=16, usedforsecurity=False)
+    return hashlib.new(hash_algo, usedforsecurity=False)
+
+def _hash_file(path, *hashes):
+    """
+    Feed the contents of the file at path into each of the hash objects.
+    """
+    with open(path, 'rb') as f:
+        # Hint the kernel to read ahead, and to not keep the pages around afterwards (not on macOS/Windows)
+        fadvise = getattr(os, 'posix_fadvise', None)
+        if fadvise:
+            fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if os.name != 'nt' and os.fstat(f.fileno()).st_size > 0:
+            # hash straight from the mapped pages, without a Python read loop
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for h in hashes:
+                    h.update(mm)
+        else:
+            for chunk in iter(lambda: f.read(4 * 1024 * 1024), b''):
+                for h in hashes:
+                    h.update(chunk)
+        if fadvise:
+            fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def _parallel_download(url, tmp, total, etag, cb=None, cb_count=10, n_parts=PARALLEL_PARTS, timeout=60):
+    """
+    Fetch url into tmp as n_parts concurrent range requests, each written at its own offset.
+    Returns the number of bytes written.
+    Raises IOError if the server doesn't answer each part with the expected 206 response.
+    """
+    part_size = (total + n_parts - 1) // n_parts
+    ranges = [(lo, min(lo + part_size, total) - 1) for lo in range(0, total, part_size)]
+    progress = CallbackWriter(None, 0, (), cb, total, cb_count)
+    lock = threading.Lock()
+
+    with open(tmp, 'wb') as f:
+        f.truncate(total)
+
+    def fetch(r):
+        lo, hi = r
+        # If-Range makes the server send the full (new) resource if it changed, which we reject below
+        n = 0
+        with _urlopen(url, {'Range': f'bytes={lo}-{hi}', 'If-Range': etag}, timeout) as response:
+            code = getattr(response, 'code', None) or response.getcode()
+            content_range = response.headers.get('Content-Range', '')
+            if code != 206 or not content_range.startswith(f'bytes {lo}-{hi}/'):
+                raise IOError(f"Unexpected response to range request {lo}-{hi}: {code} '{content_range}'")
+            with open(tmp, 'r+b') as f:
+                f.seek(lo)
+                for buf in iter(lambda: response.read(1024 * 1024), b''):
+                    f.write(buf)
+                    n += len(buf)
+                    with lock:
+                        progress.write(buf)
+        if n != hi - lo + 1:
+            raise IOError(f"Incomplete range {lo}-{hi}: got {n} bytes")
+        return n
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        return sum(executor.map(fetch, ranges))
+
+def _validate_file(path, expected_size=None, expected_digest=None, hash_algo='md5'):
     """
     Return True if file matches expectations; False otherwise.
     - expected_size: int or None
-    - expected_md5: hex string or None
+    - expected_digest: hex string or None
+    - hash_algo: algorithm of expected_digest, see _new_hash()
     """
     try:
         st = os.stat(path)
         if expected_size is not None and st.st_size != expected_size:
             return False
-        if expected_md5:
-            md5 = hashlib.md5()
-            with open(path, 'rb') as f:
-                for chunk in iter(lambda: f.read(1024 * 1024), b''):
-                    md5.update(chunk)
-            if md5.hexdigest().lower() != expected_md5.lower():
+        if expected_digest:
+            h = _new_hash(hash_algo)
+            _hash_file(path, h)
+            if h.hexdigest().lower() != expected_digest.lower():
                 return False
         return True
     except Exception:
@@ -129,10 +374,15 @@ def download(url, cb=None, cb_count=10, retries=8, timeout=60):
     c = Cache('~/.dcache', 10**9 * 4)
     attempt = 0
     last_err = None
+    permanent = False
+
+    # A partially written tmp file from a failed attempt is resumed with a Range request,
+    # as long as we know the (strong) etag it was fetched with.
+    tmp = c._url_to_path(url) + '_tmp'
+    partial_etag = None
 
     # If we have a cached file AND the server says 304, we’ll reuse it
-    # but also validate size if server returns Content-Length on 304 in later HEAD (we skip HEAD to keep simple).
-    # Instead, we validate cached file against saved suffix metadata post-304 when possible.
+    # after validating it against the size and digest stored in the index.
     while attempt < retries:
         attempt += 1
         hit = c.get(url)
@@ -143,103 +393,134 @@ def download(url, cb=None, cb_count=10, retries=8, timeout=60):
             except Exception:
                 pass
 
-        req = urllib.request.Request(url, None, headers)
+        have = os.path.getsize(tmp) if partial_etag and os.path.exists(tmp) else 0
+        if have > 0:
+            headers['Range'] = f'bytes={have}-'
+            headers['If-Range'] = partial_etag
+
         try:
-            with urllib.request.urlopen(req, timeout=timeout) as response:
+            with _urlopen(url, headers, timeout) as response:
                 code = getattr(response, 'code', None) or response.getcode()
                 if code == 304 and hit:
-                    # Trust cached, but still confirm it’s a readable file
-                    if os.path.exists(hit[0]) and os.path.getsize(hit[0]) > 0:
+                    if c.validate(url, hit):
                         return hit[0]
                     else:
-                        # cached file missing/corrupt; fall through to fresh GET by removing If-None-Match on next loop
+                        # cached file corrupt and dropped from the cache; the next loop does a fresh GET
                         hit = None
-                        last_err = RuntimeError("Cached file missing or empty after 304")
+                        last_err = RuntimeError("Cached file corrupt after 304")
                         continue
 
-                if code != 200:
+                if code == 206 and have > 0:
+                    # Content-Range: bytes <first>-<last>/<total>
+                    content_range = response.headers.get('Content-Range', '')
+                    if not content_range.startswith(f'bytes {have}-'):
+                        partial_etag = None
+                        raise IOError(f"Unexpected Content-Range '{content_range}' when resuming at {have}")
+                    mode = 'ab'
+                elif code == 200:
+                    mode = 'wb'
+                    have = 0
+                else:
                     last_err = RuntimeError(f"Unexpected HTTP status {code}")
                     raise last_err
 
                 size_hdr = response.headers.get('Content-Length')
-                expected_size = int(size_hdr) if size_hdr is not None else None
-                etag = response.headers.get('ETag', '')
+                expected_size = have + int(size_hdr) if size_hdr is not None else None
+                # A 206 may leave out the ETag, the partial file was fetched with partial_etag
+                etag = response.headers.get('ETag') or (partial_etag if have > 0 else '')
                 md5_hint = _extract_md5_from_headers(response.headers)
 
-                # Allocate cache path and temp
+                # Allocate cache path. Also done when resuming, since the entry of the
+                # first attempt was dropped by c.get() when it found no completed file.
                 # Use expected_size=0 as minimum to make room for small files
                 path = c.put(url, etag or '', expected_size or 0)
-                tmp = path + '_tmp'
+                # Only strong validators may be used with If-Range
+                partial_etag = etag if etag and not etag.startswith('W/') else None
 
-                # Remove any old tmp
-                try:
-                    if os.path.exists(tmp):
-                        os.remove(tmp)
-                except Exception:
-                    pass
+                # Hash while streaming, so the file doesn't have to be read back afterwards.
+                # When resuming, the already downloaded part is hashed up front.
+                # md5 checks the server's checksum, digest is kept in the index to validate later hits.
+                md5 = _new_hash('md5') if md5_hint else None
+                digest = _new_hash(DIGEST_ALGO)
+                hashes = (md5, digest) if md5 is not None else (digest,)
+                if have > 0:
+                    _hash_file(tmp, *hashes)
 
-                # Stream to tmp, reporting progress
-                n = 0
-                cb_i = -1  # force first progress at 0% when size known
-                with open(tmp, 'wb') as f:
-                    for buf in iter(lambda: response.read(1024 * 1024), b''):
-                        n += len(buf)
-                        f.write(buf)
-                        if cb is not None:
-                            if expected_size:
-                                rate = n / float(expected_size)
-                                step = int(rate * cb_count)
-                                if step > cb_i:
-                                    cb_i = step
-                                    cb(n, expected_size)
-                            else:
-                                # Unknown length: call occasionally with total=None
-                                if n // (1024 * 1024) != (n - len(buf)) // (1024 * 1024):
-                                    cb(n, None)
+                if (mode == 'wb' and partial_etag and expected_size and expected_size >= PARALLEL_MIN_SIZE and
+                        response.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+                    # Large file from a server that supports ranges: drop this response
+                    # and fetch the file in parallel parts instead.
+                    # The preallocated tmp file can't be resumed if this fails.
+                    response.close()
+                    partial_etag = None
+                    n = _parallel_download(url, tmp, expected_size, etag, cb, cb_count, timeout=timeout)
+                    _hash_file(tmp, *hashes)
+                else:
+                    # Stream to tmp, reporting progress
+                    with open(tmp, mode) as f:
+                        writer = CallbackWriter(f, have, hashes, cb, expected_size, cb_count)
+                        shutil.copyfileobj(response, writer, 1024 * 1024)
+                    n = writer.n
 
                 # Validation
                 if expected_size is not None and n != expected_size:
+                    if n > expected_size:
+                        partial_etag = None
                     raise IOError(f"Incomplete download: got {n} bytes, expected {expected_size}")
 
-                if md5_hint:
-                    md5 = hashlib.md5()
-                    with open(tmp, 'rb') as f:
-                        for chunk in iter(lambda: f.read(1024 * 1024), b''):
-                            md5.update(chunk)
-                    if md5.hexdigest().lower() != md5_hint.lower():
-                        raise IOError("Checksum mismatch (ETag/Content-MD5)")
+                # The running digest covers the whole file, no need to read it back
+                if md5 is not None and md5.hexdigest().lower() != md5_hint.lower():
+                    partial_etag = None
+                    raise IOError("Checksum mismatch (ETag/Content-MD5)")
 
-                # Success: atomically move into place
+                # Success: record the actual size and digest, and atomically move into place
+                c.index.put(mangle(url), path, etag or '', n, digest=digest.hexdigest())
                 os.replace(tmp, path)
+                partial_etag = None
                 return path
 
         except HTTPError as e:
             if e.code == 304 and hit:
-                if os.path.exists(hit[0]) and os.path.getsize(hit[0]) > 0:
+                if c.validate(url, hit):
                     return hit[0]
-                last_err = RuntimeError("304 returned but cached file missing/corrupt")
+                last_err = RuntimeError("304 returned but cached file corrupt")
             else:
+                if e.code == 416:
+                    # Range Not Satisfiable: the partial file is no good, start over
+                    partial_etag = None
+                permanent = e.code in PERMANENT_HTTP_ERRORS
                 last_err = e
-        except (URLError, TimeoutError, ConnectionError, IOError) as e:
+        except URLError as e:
+            # Unknown host etc (but not temporary name resolution failures)
+            permanent = isinstance(e.reason, socket.gaierror) and e.reason.errno != socket.EAI_AGAIN
+            last_err = e
+        except (TimeoutError, ConnectionError, IOError) as e:
             last_err = e
         except Exception as e:
             last_err = e
         finally:
-            # Clean up temp on failure to avoid reusing partial files
-            hit_now = c.get(url)
-            if hit_now:
-                tmp_candidate = hit_now[0] + '_tmp'
+            # Clean up temp unless it can be resumed on the next attempt
+            if not partial_etag:
                 try:
-                    if os.path.exists(tmp_candidate):
-                        os.remove(tmp_candidate)
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
                 except Exception:
                     pass
 
-        # Backoff before retry
+        if permanent:
+            break
+
+        # Backoff before retry, with jitter so that parallel builds don't retry in lockstep
         if attempt < retries:
             delay = min(2 ** (attempt - 1), 30)  # 1,2,4,8,16,30...
+            delay = round(delay * (0.5 + random.random()), 1)
             log(f"Download failed (attempt {attempt}/{retries}): {last_err}. Retrying in {delay}s...")
             time.sleep(delay)
 
     # All attempts failed
-    raise RuntimeError(f"Failed to download {url} after {retries} attempts: {last_err}")
+    try:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    except Exception:
+        pass
+    raise RuntimeError(f"Failed to download {url} after {attempt} attempts: {last_err}")
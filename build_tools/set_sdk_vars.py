@@ -27,23 +27,70 @@ echo $ANDROID_NDK_VERSION
 echo $ANDROID_BUILD_TOOLS_VERSION
 """
 
+import os
 import sys
-import sdk
+import pickle
 
-try:
-    import sdk_vendor
-except ModuleNotFoundError as e:
-    # Currently, the output is parsed by other scripts
-    if "No module named 'sdk_vendor'" in str(e):
+# The simple values (versions, package names etc) of sdk.py and sdk_vendor.py are cached here,
+# so that repeated invocations don't have to import them
+CACHE_PATH = os.path.expanduser('~/.dcache/sdk_vars.pkl')
+CACHED_TYPES = (str, int, float, bool)
+
+def _cache_key():
+    # the values depend on the sources, and on where DYNAMO_HOME is
+    key = [os.environ.get('DYNAMO_HOME'), os.getcwd()]
+    build_tools_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in ('sdk.py', 'sdk_vendor.py'):
+        path = os.path.join(build_tools_dir, name)
+        key.append((path, os.path.getmtime(path) if os.path.exists(path) else None))
+    return key
+
+def _load_cached_vars(key):
+    try:
+        with open(CACHE_PATH, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('key') == key:
+            return cached['vars']
+    except Exception:
         pass
-    else:
+    return None
+
+def _save_cached_vars(key, variables):
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp = '%s.%d' % (CACHE_PATH, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'key': key, 'vars': variables}, f)
+        os.replace(tmp, CACHE_PATH)
+    except Exception:
+        pass # the cache is only an optimization
+
+def _import_modules():
+    import sdk
+
+    try:
+        import sdk_vendor
+    except ModuleNotFoundError as e:
+        # Currently, the output is parsed by other scripts
+        if "No module named 'sdk_vendor'" in str(e):
+            sdk_vendor = None
+        else:
+            raise e
+    except Exception as e:
+        print("Failed to import sdk_vendor.py:")
         raise e
-except Exception as e:
-    print("Failed to import sdk_vendor.py:")
-    raise e
+    return sdk, sdk_vendor
 
-if 'sdk_vendor' not in sys.modules:
-    sdk_vendor = None
+def _load_vars():
+    sdk, sdk_vendor = _import_modules()
+    variables = {}
+    for module in (sdk_vendor, sdk): # sdk.py takes precedence
+        if module is None:
+            continue
+        for name, value in vars(module).items():
+            if not name.startswith('_') and isinstance(value, CACHED_TYPES):
+                variables[name] = value
+    return variables
 
 
 def main():
@@ -51,10 +98,20 @@ def main():
         print("Usage: set_sdk_vars.py VAR1 VAR2 ...")
         sys.exit(1)
 
+    key = _cache_key()
+    variables = _load_cached_vars(key)
+    if variables is None:
+        variables = _load_vars()
+        _save_cached_vars(key, variables)
+
     for var_name in sys.argv[1:]:
-        attr = getattr(sdk, var_name, None)
+        attr = variables.get(var_name, None)
         if attr is None:
-            attr = getattr(sdk_vendor, var_name, None)
+            # not a simple value, look it up in the modules themselves
+            sdk, sdk_vendor = _import_modules()
+            attr = getattr(sdk, var_name, None)
+            if attr is None:
+                attr = getattr(sdk_vendor, var_name, None)
 
         if attr is None:
             print(f"Error: {var_name} is not defined in sdk.py", file=sys.stderr)
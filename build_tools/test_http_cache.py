@@ -0,0 +1,105 @@
+# Copyright 2020-2026 The Defold Foundation
+# Copyright 2014-2020 King
+# Copyright 2009-2014 Ragnar Svensson, Christian Murray
+# Licensed under the Defold License version 1.0 (the "License"); you may not use
+# this file except in compliance with the License.
+#
+# You may obtain a copy of the License, together with FAQs at
+# https://www.defold.com/license
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os, sys, shutil, tempfile, threading, hashlib, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import http_cache
+
+DATA = os.urandom(256 * 1024)
+ETAG = '"%s"' % hashlib.md5(DATA).hexdigest()
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # The first full GET is cut off halfway, to make download() resume
+    truncate_next = True
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        RangeHandler.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == ETAG:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.end_headers()
+
+        body = DATA[start:]
+        if start == 0 and RangeHandler.truncate_next:
+            RangeHandler.truncate_next = False
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.close_connection = True
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        env = {k: v for k, v in os.environ.items() if not k.lower().endswith('_proxy')}
+        env['HOME'] = self.home
+        self.env = mock.patch.dict(os.environ, env, clear=True)
+        self.env.start()
+        RangeHandler.truncate_next = True
+        RangeHandler.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/sdk/archive.tar.gz' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.env.stop()
+        shutil.rmtree(self.home)
+
+    def test_resume_then_cache_hit(self):
+        with mock.patch.object(http_cache.time, 'sleep'):
+            path = http_cache.download(self.url)
+        with open(path, 'rb') as f:
+            self.assertEqual(DATA, f.read())
+        self.assertEqual('bytes=%d-' % (len(DATA) // 2), RangeHandler.requests[-1].get('Range'))
+
+        # The resumed download must be in the index, so the next one is a 304 hit
+        self.assertEqual(path, http_cache.download(self.url))
+        self.assertEqual(ETAG, RangeHandler.requests[-1].get('If-None-Match'))
+        self.assertEqual(3, len(RangeHandler.requests))
+
+    def test_corrupt_cache_hit(self):
+        RangeHandler.truncate_next = False
+        path = http_cache.download(self.url)
+        with open(path, 'r+b') as f:
+            f.write(b'CORRUPTED')
+
+        # Same size, but the digest in the index doesn't match, so it's fetched again
+        with mock.patch.object(http_cache.time, 'sleep'):
+            self.assertEqual(path, http_cache.download(self.url))
+        with open(path, 'rb') as f:
+            self.assertEqual(DATA, f.read())
+        self.assertNotIn('If-None-Match', RangeHandler.requests[-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,6 +22,7 @@ import hashlib, sys, os, importlib
 # Otherwise field_desc.GetOptions().ListFields() will return [] for the first loaded module
 # Strange error and probably a bug in google protocol buffers
 import ddf.ddf_extensions_pb2
+from google.protobuf.descriptor import FieldDescriptor
 
 from importlib.machinery import PathFinder
 
@@ -51,61 +52,143 @@ def apply_content_root(self):
     waflib.Utils.def_attrs(self, content_root = '.')
     self.content_root = self.path.find_dir(self.content_root).abspath()
 
+def is_resource(field_desc):
+    for options_field_desc, value in field_desc.GetOptions().ListFields():
+        if options_field_desc.name == 'resource' and value:
+            return True
+    return False
+
+# Per message descriptor: (name, message_type, is_repeated, is_optional) for the
+# fields that are sub-messages or resources, in declaration order. message_type
+# is None for resource fields
+resource_plans = {}
+
+def get_resource_plan(descriptor):
+    plan = resource_plans.get(descriptor)
+    if plan is None:
+        plan = []
+        for field in descriptor.fields:
+            is_repeated = field.label == FieldDescriptor.LABEL_REPEATED
+            if field.type == FieldDescriptor.TYPE_MESSAGE:
+                plan.append((field.name, field.message_type, is_repeated, False))
+            elif is_resource(field):
+                plan.append((field.name, None, is_repeated, field.label == FieldDescriptor.LABEL_OPTIONAL))
+        plan = tuple(plan)
+        resource_plans[descriptor] = plan
+    return plan
+
+def register_resource_plans(descriptor):
+    # Build the plans for a message type and every message type it contains
+    # up front, so walking messages later is only dict lookups
+    stack = [descriptor]
+    while stack:
+        descriptor = stack.pop()
+        if descriptor in resource_plans:
+            continue
+        get_resource_plan(descriptor)
+        for field in descriptor.fields:
+            if field.type == FieldDescriptor.TYPE_MESSAGE:
+                stack.append(field.message_type)
+
+resource_subtrees = {}
+
+def has_resources(descriptor):
+    # True if the message type, or any message type reachable from it, has
+    # resource fields. Message types can be recursive, so search the whole
+    # reachable set instead of combining results of the nested types
+    result = resource_subtrees.get(descriptor)
+    if result is None:
+        result = False
+        seen = set()
+        stack = [descriptor]
+        while stack:
+            d = stack.pop()
+            if d in seen:
+                continue
+            seen.add(d)
+            plan = get_resource_plan(d)
+            if any(message_type is None for _, message_type, _, _ in plan):
+                result = True
+                break
+            stack.extend(message_type for _, message_type, _, _ in plan)
+        resource_subtrees[descriptor] = result
+    return result
+
+def iter_resources(msg, recursive = True):
+    # Yields (path, is_optional, is_nested) for every resource field in msg
+    # and, if recursive, its sub-messages, depth first in field order
+    stack = [msg]
+    while stack:
+        item = stack.pop()
+        if type(item) is tuple:
+            yield item
+            continue
+
+        is_nested = item is not msg
+        children = []
+        for name, message_type, is_repeated, is_optional in get_resource_plan(item.DESCRIPTOR):
+            if message_type is not None:
+                # Skip sub-messages that can't contain any resources
+                if not recursive or not has_resources(message_type):
+                    continue
+                value = getattr(item, name)
+                if is_repeated:
+                    children.extend(value)
+                else:
+                    children.append(value)
+                continue
+
+            value = getattr(item, name)
+            if is_repeated:
+                children.extend((x, False, is_nested) for x in value)
+            else:
+                children.append((value, is_optional, is_nested))
+        stack.extend(reversed(children))
+
 proto_module_sigs = {}
-def proto_compile_task(name, module, msg_type, input_ext, output_ext, transformer = None, append_to_all = False):
+proto_msg_classes = {}
+
+def get_msg_class(module, msg_type):
+    key = (module, msg_type)
+    cls = proto_msg_classes.get(key)
+    if cls is None:
+        mod = __import__(module)
+        # NOTE: We can't use getattr. msg_type could of form "foo.bar"
+        cls = eval('mod.' + msg_type)
+        register_resource_plans(cls.DESCRIPTOR)
+        proto_msg_classes[key] = cls
+    return cls
 
-    # NOTE: This could be cached
-    def is_resource(field_desc):
-        for options_field_desc, value in field_desc.GetOptions().ListFields():
-            if options_field_desc.name == 'resource' and value:
-                return True
-        return False
+def proto_compile_task(name, module, msg_type, input_ext, output_ext, transformer = None, append_to_all = False):
 
     def validate_resource_files(task, msg):
-        import google.protobuf
-        from google.protobuf.descriptor import FieldDescriptor
-
-        descriptor = getattr(msg, 'DESCRIPTOR')
-        for field in descriptor.fields:
-            value = getattr(msg, field.name)
-            if field.type == FieldDescriptor.TYPE_MESSAGE:
-                if field.label == FieldDescriptor.LABEL_REPEATED:
-                    for x in value:
-                        validate_resource_files(task, x)
-                else:
-                    validate_resource_files(task, value)
-            elif is_resource(field):
+        # NOTE: Errors in sub-messages are reported but, as before, only
+        # top-level resources fail the task
+        for x, is_optional, is_nested in iter_resources(msg):
+            if is_optional and len(x) == 0:
+                # Skip not specified optional fields
+                # These are accepted as "resources"
+                continue
 
-                if field.label == FieldDescriptor.LABEL_REPEATED:
-                    lst = value
-                else:
-                    lst = [value]
-
-                for x in lst:
-                    if field.label == FieldDescriptor.LABEL_OPTIONAL and len(x) == 0:
-                        # Skip not specified optional fields
-                        # These are accepted as "resources"
-                        # NOTE: Somewhat strange to test this predicate in a loop
-                        # as optional can't be repeated. Anyway it works :-)
-                        continue
-
-                    if not x.startswith('/'):
-                        print ('%s:0: error: resource path is not absolute "%s"' % (task.inputs[0].srcpath(), x), file=sys.stderr)
-                        return False
-                    path = os.path.join(task.generator.content_root, x[1:])
-                    if not os.path.exists(path):
-                        print ('%s:0: error: is missing dependent resource file "%s"' % (task.inputs[0].srcpath(), x), file=sys.stderr)
-                        return False
+            if not x.startswith('/'):
+                print ('%s:0: error: resource path is not absolute "%s"' % (task.inputs[0].srcpath(), x), file=sys.stderr)
+                if not is_nested:
+                    return False
+                continue
+            path = os.path.join(task.generator.content_root, x[1:])
+            if not os.path.exists(path):
+                print ('%s:0: error: is missing dependent resource file "%s"' % (task.inputs[0].srcpath(), x), file=sys.stderr)
+                if not is_nested:
+                    return False
         return True
 
     def compile(task):
         try:
             import google.protobuf.text_format
-            mod = __import__(module)
-            # NOTE: We can't use getattr. msg_type could of form "foo.bar"
-            msg = eval('mod.' + msg_type)() # Call constructor on message type
+            msg = get_msg_class(module, msg_type)()
             with open(task.inputs[0].srcpath(), 'rb') as in_f:
-                google.protobuf.text_format.Merge(in_f.read(), msg)
+                # Parse line by line rather than reading the whole file first
+                google.protobuf.text_format.MergeLines(in_f, msg)
 
             if not validate_resource_files(task, msg):
                 return 1
@@ -168,31 +251,13 @@ def proto_compile_task(name, module, msg_type, input_ext, output_ext, transforme
         return m.digest()
 
     def scan_msg(task, msg):
-        import google.protobuf
-        from google.protobuf.descriptor import FieldDescriptor
+        # NOTE: Only top-level resources have ever been added as dependencies
         depnodes = []
-
-        descriptor = getattr(msg, 'DESCRIPTOR')
-        for field in descriptor.fields:
-            value = getattr(msg, field.name)
-            if field.type == FieldDescriptor.TYPE_MESSAGE:
-                if field.label == FieldDescriptor.LABEL_REPEATED:
-                    for x in value:
-                        scan_msg(task, x)
-                else:
-                    scan_msg(task, value)
-            elif is_resource(field):
-
-                if field.label == FieldDescriptor.LABEL_REPEATED:
-                    lst = value
-                else:
-                    lst = [value]
-
-                for x in lst:
-                    # NOTE: find_resource doesn't handle unicode string. Thats why str(.) is required
-                    n = task.generator.path.find_resource(str(x[1:]))
-                    if n:
-                        depnodes.append(n)
+        for x, _, _ in iter_resources(msg, recursive = False):
+            # NOTE: find_resource doesn't handle unicode string. Thats why str(.) is required
+            n = task.generator.path.find_resource(str(x[1:]))
+            if n:
+                depnodes.append(n)
         return depnodes
 
     def scan(task):
@@ -205,11 +270,9 @@ def proto_compile_task(name, module, msg_type, input_ext, output_ext, transforme
 
             try:
                 import google.protobuf.text_format
-                mod = __import__(module)
-                # NOTE: We can't use getattr. msg_type could of form "foo.bar"
-                msg = eval('mod.' + msg_type)() # Call constructor on message type
+                msg = get_msg_class(module, msg_type)()
                 with open(n.srcpath(), 'rb') as in_f:
-                    google.protobuf.text_format.Merge(in_f.read(), msg)
+                    google.protobuf.text_format.MergeLines(in_f, msg)
 
                 depnodes += scan_msg(task, msg)
 
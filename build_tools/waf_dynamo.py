@@ -1387,47 +1387,46 @@ def create_copy_glue(self):
     task = self.create_task('copy_stub')
     task.set_outputs([stub])
 
+EMBED_HEX = [hex(x) + ', ' for x in range(256)]
+EMBED_CHUNK_SIZE = 64 * 1024 # must be a multiple of 4
+
+def embed_hex(data, offset):
+    # Five values on the first line, then four per line.
+    # A chunk at a non-zero offset continues the previous line
+    first = 5 if offset == 0 else 1
+    lines = [''.join(map(EMBED_HEX.__getitem__, data[:first]))]
+    lines.extend(''.join(map(EMBED_HEX.__getitem__, data[i:i+4])) for i in range(first, len(data), 4))
+    return '\n    '.join(lines)
+
 def embed_build(task):
     symbol = task.inputs[0].name.upper().replace('.', '_').replace('-', '_').replace('@', 'at')
-    in_file = open(task.inputs[0].abspath(), 'rb').read()
-    cpp_out_file = open(task.outputs[0].abspath(), 'w')
-    h_out_file = open(task.outputs[1].abspath(), 'w')
 
     cpp_str = """
 #include <stdint.h>
 #include "dlib/align.h"
 unsigned char DM_ALIGNED(16) %s[] =
 """
-    cpp_out_file.write(cpp_str % (symbol))
-    cpp_out_file.write('{\n    ')
-    data = in_file
-    data_is_binary = type(data) == bytes
-
-    tmp = ''
-    for i,x in enumerate(data):
-        if data_is_binary:
-            tmp += hex(x) + ', '
-        else:
-            tmp += hex(ord(x)) + ', '
-        if i > 0 and i % 4 == 0:
-            tmp += '\n    '
-
-    cpp_out_file.write(tmp)
-    cpp_out_file.write('\n};\n')
-    cpp_out_file.write('uint32_t %s_SIZE = sizeof(%s);\n' % (symbol, symbol))
-
-    h_out_file.write('extern unsigned char %s[];\n' % (symbol))
-    h_out_file.write('extern uint32_t %s_SIZE;\n' % (symbol))
-
-    cpp_out_file.close()
-    h_out_file.close()
-
     m = Utils.md5()
-
-    if data_is_binary:
-        m.update(data)
-    else:
-        m.update(data.encode('utf-8'))
+    size = 0
+    with open(task.inputs[0].abspath(), 'rb') as in_file, open(task.outputs[0].abspath(), 'w') as cpp_out_file:
+        cpp_out_file.write(cpp_str % (symbol))
+        cpp_out_file.write('{\n    ')
+        while True:
+            data = in_file.read(EMBED_CHUNK_SIZE)
+            if not data:
+                break
+            m.update(data)
+            cpp_out_file.write(embed_hex(data, size))
+            size += len(data)
+        if size >= 5 and size % 4 == 1:
+            cpp_out_file.write('\n    ')
+
+        cpp_out_file.write('\n};\n')
+        cpp_out_file.write('uint32_t %s_SIZE = sizeof(%s);\n' % (symbol, symbol))
+
+    with open(task.outputs[1].abspath(), 'w') as h_out_file:
+        h_out_file.write('extern unsigned char %s[];\n' % (symbol))
+        h_out_file.write('extern uint32_t %s_SIZE;\n' % (symbol))
 
     task.generator.bld.node_sigs[task.inputs[0]] = m.digest()
 
@@ -17,6 +17,7 @@
 
 import json
 import time
+import random
 import os
 import os.path as path
 import stat
@@ -25,29 +26,32 @@ import optparse
 import platform
 import re
 import shutil
+import struct
+import copy
 import subprocess
 import zipfile
 import tarfile
 import configparser
 import datetime
 import fnmatch
+import functools
+import threading
 import urllib
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'build_tools'))
 
 # TODO: collect common functions in a more suitable reusable module
 try:
-    sys.dont_write_bytecode = True
     import build_private
-except Exception as e:
+except ImportError:
     class build_private(object):
         @classmethod
-        def get_tag_suffix(self):
+        def get_tag_suffix(cls):
             return ''
-finally:
-    sys.dont_write_bytecode = False
 
 # defold/build_tools
 import run
@@ -67,6 +71,7 @@ platform_to_java = {'x86_64-linux': 'x64_linux',
                     'arm64-macos': 'aarch64_mac',
                     'x86_64-win32': 'x64_windows'}
 
+@functools.cache
 def current_platform():
     system = platform.system()
     machine = platform.machine()
@@ -83,6 +88,7 @@ def current_platform():
     else:
         return "x86_64-win32"
 
+@functools.cache
 def has_rosetta():
     arch_cmd = shutil.which('arch')
     if not arch_cmd:
@@ -93,12 +99,13 @@ def has_rosetta():
         return False
     return result.returncode == 0
 
+@functools.cache
 def supported_platforms():
     current = current_platform()
     supported = {current}
     if current == 'arm64-macos' and has_rosetta():
         supported.add('x86_64-macos')
-    return supported
+    return frozenset(supported) # cached, so it mustn't be modified
 
 def platform_is_macos(platform):
     return platform.endswith("-macos")
@@ -119,7 +126,20 @@ def mkdirs(path):
         os.makedirs(path)
 
 def extract_tar(file, path):
-    run.command(['tar', '-C', path, '-xzf', file])
+    if shutil.which('pigz'):
+        run.command(['tar', '-C', path, '--use-compress-program=pigz', '-xf', file])
+    else:
+        run.command(['tar', '-C', path, '-xzf', file])
+
+def extract_zip_members(file, names, path):
+    # each worker needs its own ZipFile, they can't be shared between threads
+    with zipfile.ZipFile(file, 'r') as zf:
+        for name in names:
+            try:
+                zf.extract(name, path)
+            except FileExistsError:
+                # another worker created the same folder at the same time
+                zf.extract(name, path)
 
 def extract_zip(file, path):
     if sys.platform == 'darwin':
@@ -130,19 +150,28 @@ def extract_zip(file, path):
         run.command(['unzip', file, '-d', path])
     else:
         with zipfile.ZipFile(file, 'r') as zf:
-            zf.extractall(path)
+            names = zf.namelist()
+        workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(extract_zip_members, repeat(file), [names[i::workers] for i in range(workers)], repeat(path)))
 
 def extract(file, path):
     log('Extracting %s to %s' % (file, path))
-    if fnmatch.fnmatch(file, "*.tar.gz-*"):
+    # http_cache keeps the extension of the url, entries from its old layout also have an etag suffix
+    if fnmatch.fnmatch(file, "*.tar.gz") or fnmatch.fnmatch(file, "*.tar.gz-*"):
         extract_tar(file, path)
-    elif fnmatch.fnmatch(file, "*.zip-*"):
+    elif fnmatch.fnmatch(file, "*.zip") or fnmatch.fnmatch(file, "*.zip-*"):
         extract_zip(file, path)
     else:
         assert False, "Don't know how to extract " + file
 
+# number of downloads running, the JDKs are downloaded concurrently
+_downloads_in_flight = 0
+_downloads_lock = threading.Lock()
+
 def progress_bar(label, count, total, url, width=40):
-    is_tty = sys.stdout.isatty()
+    # concurrent downloads would overwrite each other's bar, so they log a line per update instead
+    is_tty = sys.stdout.isatty() and _downloads_in_flight <= 1
     if is_tty:
         percent = count / total if total else 0
         filled = int(width * percent)
@@ -158,8 +187,15 @@ def progress_bar(label, count, total, url, width=40):
         log('Downloading %s %.2f%%' % (url, 100 * count / float(total)))
 
 def download(label, url):
+    global _downloads_in_flight
     label = 'Downloading %s...' % label
-    path = http_cache.download(url, lambda count, total: progress_bar(label, count, total, url))
+    with _downloads_lock:
+        _downloads_in_flight += 1
+    try:
+        path = http_cache.download(url, lambda count, total: progress_bar(label, count, total, url))
+    finally:
+        with _downloads_lock:
+            _downloads_in_flight -= 1
     if not path:
         log('Failed to download %s' % url)
         sys.exit(5)
@@ -169,13 +205,24 @@ def ziptree(path, outfile, directory = None):
     # Directory is similar to -C in tar
 
     zip = zipfile.ZipFile(outfile, 'w')
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            p = os.path.join(root, f)
-            an = p
-            if directory:
-                an = os.path.relpath(p, directory)
-            zip.write(p, an)
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # like os.walk, don't follow symlinked folders
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                    continue
+                p = entry.path
+                an = p
+                if directory:
+                    an = os.path.relpath(p, directory)
+                # same as ZipFile.write(), but copying in larger chunks
+                zi = zipfile.ZipInfo.from_file(p, an)
+                zi.compress_type = zip.compression
+                with open(p, 'rb') as src, zip.open(zi, 'w') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
 
     zip.close()
     return outfile
@@ -183,16 +230,33 @@ def ziptree(path, outfile, directory = None):
 def gz_tree(path, outfile, directory=None):
     # compress files and folders in path to outfile using tar:gz compression
 
-    archive = tarfile.open(outfile, 'w:gz')
+    paths = []
     for root, dirs, files in os.walk(path):
         for f in files:
-            p = os.path.join(root, f)
+            paths.append(os.path.join(root, f))
+    # sorted, so that similar files end up next to each other for the compressor
+    paths.sort()
+
+    def add_files(archive):
+        for p in paths:
             an = p
             if directory:
                 an = os.path.relpath(p, directory)
-            archive.add(p, an)
-
-    archive.close()
+            archive.add(p, arcname=an, recursive=False)
+        archive.close()
+
+    # stream mode, the archive is only ever appended to
+    pigz = shutil.which('pigz')
+    if pigz:
+        # compress on all cores
+        with open(outfile, 'wb') as out:
+            process = subprocess.Popen([pigz, '-p', str(os.cpu_count() or 1)], stdin = subprocess.PIPE, stdout = out)
+            add_files(tarfile.open(fileobj=process.stdin, mode='w|', bufsize=1024 * 1024))
+            process.stdin.close()
+            if process.wait() != 0:
+                sys.exit("Failed to compress %s with pigz (exit code %d)" % (outfile, process.returncode))
+    else:
+        add_files(tarfile.open(outfile, 'w|gz', bufsize=1024 * 1024))
     return outfile
 
 
@@ -248,38 +312,51 @@ def mac_certificate(codesigning_identity):
     else:
         return None
 
+# Google Cloud access tokens are valid for an hour
+GCLOUD_TOKEN_TTL = 55 * 60
+_gcloud_tokens = {} # keyfile -> (token, time)
+
+def gcloud_access_token(gcloud, keyfile):
+    cached = _gcloud_tokens.get(keyfile)
+    if cached and time.monotonic() - cached[1] < GCLOUD_TOKEN_TTL:
+        return cached[0]
+
+    run.command([
+        gcloud,
+        'auth',
+        'activate-service-account',
+        '--key-file', keyfile], silent = True)
+
+    # Capture the token ourselves so we can strip any stray lines emitted by the Windows
+    # Microsoft Store shim when `python.exe` is missing (it writes that warning to stdout).
+    token_proc = subprocess.run(
+        [gcloud, 'auth', 'print-access-token'],
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        check = False,
+        text = True)
+    if token_proc.returncode != 0:
+        log("gcloud auth print-access-token failed with exit code %d" % token_proc.returncode)
+        if token_proc.stderr:
+            log(token_proc.stderr.strip())
+        sys.exit(1)
+
+    token_lines = [line.strip() for line in token_proc.stdout.splitlines() if line.strip()]
+    if not token_lines:
+        log("Failed to read Google Cloud access token from gcloud output")
+        if token_proc.stderr:
+            log(token_proc.stderr.strip())
+        sys.exit(1)
+    token = token_lines[-1]
+    _gcloud_tokens[keyfile] = (token, time.monotonic())
+    return token
+
 def sign_file(platform, options, file):
     if platform_is_windows(platform):
         if not shutil.which('gcloud'):
             sys.exit("No gcloud tool found")
         gcloud = shutil.which('gcloud')
-        run.command([
-            gcloud,
-            'auth',
-            'activate-service-account',
-            '--key-file', options.gcloud_keyfile], silent = True)
-
-        # Capture the token ourselves so we can strip any stray lines emitted by the Windows
-        # Microsoft Store shim when `python.exe` is missing (it writes that warning to stdout).
-        token_proc = subprocess.run(
-            [gcloud, 'auth', 'print-access-token'],
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            check = False,
-            text = True)
-        if token_proc.returncode != 0:
-            log("gcloud auth print-access-token failed with exit code %d" % token_proc.returncode)
-            if token_proc.stderr:
-                log(token_proc.stderr.strip())
-            sys.exit(1)
-
-        token_lines = [line.strip() for line in token_proc.stdout.splitlines() if line.strip()]
-        if not token_lines:
-            log("Failed to read Google Cloud access token from gcloud output")
-            if token_proc.stderr:
-                log(token_proc.stderr.strip())
-            sys.exit(1)
-        storepass = token_lines[-1]
+        storepass = gcloud_access_token(gcloud, options.gcloud_keyfile)
 
         jsign = os.path.join(os.environ['DYNAMO_HOME'], 'ext','share','java','jsign-4.2.jar')
         keystore = "projects/%s/locations/%s/keyRings/%s" % (options.gcloud_projectid, options.gcloud_location, options.gcloud_keyringname)
@@ -295,20 +372,25 @@ def sign_file(platform, options, file):
             file], silent = True)
 
     if platform_is_macos(platform):
-        codesigning_identity = options.codesigning_identity
-        certificate = mac_certificate(codesigning_identity)
-        if certificate is None:
-            log("Codesigning certificate not found for signing identity %s" % codesigning_identity)
-            sys.exit(1)
+        codesign(mac_signing_certificate(options), [file])
 
-        run.command([
-            'codesign',
-            '--deep',
-            '--force',
-            '--options', 'runtime',
-            '--entitlements', './scripts/entitlements.plist',
-            '-s', certificate,
-            file])
+def mac_signing_certificate(options):
+    codesigning_identity = options.codesigning_identity
+    certificate = mac_certificate(codesigning_identity)
+    if certificate is None:
+        log("Codesigning certificate not found for signing identity %s" % codesigning_identity)
+        sys.exit(1)
+    return certificate
+
+def codesign(certificate, files):
+    # codesign takes any number of paths, signing them all in one process
+    run.command([
+        'codesign',
+        '--deep',
+        '--force',
+        '--options', 'runtime',
+        '--entitlements', './scripts/entitlements.plist',
+        '-s', certificate] + files)
 
 def launcher_path(options, platform, exe_suffix):
     if options.launcher:
@@ -355,15 +437,55 @@ def write_docs(docs_dir, jdk_path=None):
 def get_exe_suffix(platform):
     return ".exe" if 'win32' in platform else ""
 
-def remove_platform_files_from_archive(platform, jar):
+def copy_zip_entry_raw(zin, zout, info):
+    # Copy an entry as-is, without decompressing and recompressing it
+    # (zipfile has no public API for this, so it writes to zout's file directly)
+    zin.fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    zin.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    out = copy.copy(info)
+    # sizes and crc are known, so they go in the local header instead of a data descriptor
+    out.flag_bits &= ~0x08
+    out.header_offset = zout.fp.tell()
+    zout.fp.write(out.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        buf = zin.fp.read(min(remaining, 1024 * 1024))
+        if not buf:
+            raise zipfile.BadZipFile("Truncated entry %s" % info.filename)
+        zout.fp.write(buf)
+        remaining -= len(buf)
+
+    zout.filelist.append(out)
+    zout.NameToInfo[out.filename] = out
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+def remove_platform_files_from_archive(platform, jar, dst=None):
+    # writes the stripped jar to dst, or replaces jar if no dst is given
     zin = zipfile.ZipFile(jar, 'r')
-    files = zin.namelist()
-    files_to_remove = []
+    files_to_remove = set()
+
+    # libs in the root folder that belong to other platforms
+    if platform in ["x86_64-macos", "arm64-macos"]:
+        root_libs_to_remove = (".so", ".dll")
+    elif platform in ["x86_64-win32"]:
+        root_libs_to_remove = (".so", ".dylib")
+    elif platform in ["x86_64-linux", "arm64-linux"]:
+        root_libs_to_remove = (".dll", ".dylib")
+    else:
+        root_libs_to_remove = ()
 
-    # find files to remove from libexec/*
     libexec_platform = "libexec/" + platform
     _unpack_platform = "_unpack/" + platform
-    for file in files:
+    for file in zin.namelist():
+        # find libs to remove in the root folder
+        if "/" not in file:
+            if file.endswith(root_libs_to_remove):
+                files_to_remove.add(file)
+            continue
+        # find files to remove from libexec/*
         if file.startswith("libexec"):
             # don't remove any folders
             if file.endswith("/"):
@@ -378,9 +500,9 @@ def remove_platform_files_from_archive(platform, jar):
             if "bundletool-all.jar" in file:
                 continue
             # anything else should be removed
-            files_to_remove.append(file)
+            files_to_remove.add(file)
         # keep files needed only for this particular platform (+ shared files in '_defold' and 'shared')
-        if file.startswith("_unpack"):
+        elif file.startswith("_unpack"):
             # don't touch '_unpack/'
             if file == "_unpack/":
                 continue
@@ -394,32 +516,35 @@ def remove_platform_files_from_archive(platform, jar):
             if file.startswith("_unpack/_defold"):
                 continue
             # anything else should be removed
-            files_to_remove.append(file)
+            files_to_remove.add(file)
 
-
-    # find libs to remove in the root folder
-    for file in files:
-        if "/" not in file:
-            if platform in ["x86_64-macos", "arm64-macos"] and (file.endswith(".so") or file.endswith(".dll")):
-                files_to_remove.append(file)
-            elif platform in ["x86_64-win32"] and (file.endswith(".so") or file.endswith(".dylib")):
-                files_to_remove.append(file)
-            elif platform in ["x86_64-linux", "arm64-linux"]  and (file.endswith(".dll") or file.endswith(".dylib")):
-                files_to_remove.append(file)
+    if not files_to_remove:
+        # nothing to strip, no need to rewrite the jar
+        zin.close()
+        if dst:
+            shutil.copyfile(jar, dst)
+        return
 
     # write new jar without the files that should be removed
-    newjar = jar + "_new"
+    newjar = dst or jar + "_new"
     zout = zipfile.ZipFile(newjar, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
     for file in zin.infolist():
         if file.filename not in files_to_remove:
-            zout.writestr(file, zin.read(file))
+            copy_zip_entry_raw(zin, zout, file)
     zout.close()
     zin.close()
 
-    # switch to jar without removed files
-    os.remove(jar)
-    os.rename(newjar, jar)
+    if not dst:
+        # switch to jar without removed files
+        os.remove(jar)
+        os.rename(newjar, jar)
+
 
+@functools.cache
+def read_base_config():
+    # the same for all platforms, only the build section is changed per bundle
+    with open('bundle-resources/config', 'r') as f:
+        return f.read()
 
 def create_bundle(jdk, platform, options):
     mkdirs('target/editor')
@@ -458,7 +583,7 @@ def create_bundle(jdk, platform, options):
 
     # creating editor config file
     config = configparser.ConfigParser()
-    config.read('bundle-resources/config')
+    config.read_string(read_base_config())
     config.set('build', 'editor_sha1', options.editor_sha1)
     config.set('build', 'engine_sha1', options.engine_sha1)
     config.set('build', 'version', options.version)
@@ -472,10 +597,8 @@ def create_bundle(jdk, platform, options):
         config.write(f)
 
     defold_jar = '%s/defold-%s.jar' % (packages_dir, options.editor_sha1)
-    shutil.copy(jar_file, defold_jar)
-
     # strip tools and libs for the platforms we're not currently bundling
-    remove_platform_files_from_archive(platform, defold_jar)
+    remove_platform_files_from_archive(platform, jar_file, defold_jar)
 
     # copy editor executable (the launcher)
     launcher = launcher_path(options, platform, get_exe_suffix(platform))
@@ -522,22 +645,37 @@ def sign(bundle_dir, platform, options):
         # the *.app will not process files in Resources
         jdk_dir = "jdk-%s" % java_version
         jdk_path = os.path.join(bundle_dir, "Contents", "Resources", "packages", jdk_dir)
-        for exe in find_files(os.path.join(jdk_path, "bin"), "*"):
-            sign_file(platform, options, exe)
-        for lib in find_files(os.path.join(jdk_path, "lib"), "*.dylib"):
-            sign_file(platform, options, lib)
-        sign_file(platform, options, os.path.join(jdk_path, "lib", "jspawnhelper"))
-        sign_file(platform, options, bundle_dir)
+        files = find_files(os.path.join(jdk_path, "bin"), "*") + find_files(os.path.join(jdk_path, "lib"), "*.dylib")
+        files.append(os.path.join(jdk_path, "lib", "jspawnhelper"))
+        # one keychain lookup and one codesign process for all of them,
+        # the .app has to be signed after its contents
+        certificate = mac_signing_certificate(options)
+        codesign(certificate, files)
+        codesign(certificate, [bundle_dir])
     elif platform_is_windows(platform):
         sign_file(platform, options, os.path.join(bundle_dir, "Defold.exe"))
 
 def find_files(root_dir, file_pattern):
+    # '*' and '*.ext' are the patterns we use, and they don't need fnmatch
+    suffix = file_pattern[1:]
+    if file_pattern.startswith('*') and not any(c in suffix for c in '*?['):
+        match = lambda name: name.endswith(suffix)
+    else:
+        match = lambda name: fnmatch.fnmatch(name, file_pattern)
+
     matches = []
-    for root, dirnames, filenames in os.walk(root_dir):
-        for filename in filenames:
-            fullname = os.path.join(root, filename)
-            if fnmatch.fnmatch(filename, file_pattern):
-                matches.append(fullname)
+    if not os.path.isdir(root_dir):
+        return matches
+    dirs = [root_dir]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # like os.walk, don't follow symlinked folders
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                elif match(entry.name):
+                    matches.append(entry.path)
     return matches
 
 def create_dmg(bundle_dir, options, platform):
@@ -547,10 +685,14 @@ def create_dmg(bundle_dir, options, platform):
     mkdirs(dmg_dir)
 
     # create file tree for the .dmg
-    # It's important to use symlinks=True, otherwise notarization will fail
-    # since copytree will resolve them while copying (making them no longer
-    # signed)
-    shutil.copytree(bundle_dir, '%s/Defold.app' % dmg_dir, symlinks=True)
+    # It's important to keep the symlinks, otherwise notarization will fail
+    # since the copy would resolve them (making them no longer signed)
+    # Clone the files (APFS copy-on-write) with cp -c, so no data is actually copied
+    app_dir = '%s/Defold.app' % dmg_dir
+    if subprocess.run(['cp', '-cR', bundle_dir, app_dir]).returncode != 0:
+        log("Failed to clone %s, copying it instead" % bundle_dir)
+        rmtree(app_dir)
+        shutil.copytree(bundle_dir, app_dir, symlinks=True)
     shutil.copy('bundle-resources/dmg_ds_store', '%s/.DS_Store' % dmg_dir)
     shutil.copytree('bundle-resources/dmg_background', '%s/.background' % dmg_dir)
     run.command(['ln', '-sf', '/Applications', '%s/Applications' % dmg_dir])
@@ -611,8 +753,11 @@ def notarize(app, notarization_username, notarization_password, notarization_tea
     id = res["id"]
     log('UUID for notarization request is "{}"'.format(id))
 
+    # poll less often the longer it takes, with some jitter
+    delay = 15
     while True:
-        time.sleep(15)
+        time.sleep(delay + random.uniform(0, 2))
+        delay = min(delay * 2, 90)
         log('Checking notarization status for "{}"'.format(id))
         status = notarization_status(id, notarization_username, notarization_password, notarization_team_id)
         if status == "Accepted":
@@ -671,20 +816,27 @@ def build(options):
     if options.engine_sha1:
         init_command += [options.engine_sha1]
 
-    for platform in options.target_platform:
-        log("Building editor for %s..." % platform)
-        jdk = get_jdk(platform)
-        invoke_lein(init_command, jdk_path=jdk)
-        invoke_lein(['run', '-m', 'editor.ns-batch-builder', 'resources/sorted_clojure_ns_list.edn'], jdk_path=jdk)
-        if options.skip_tests:
-            log("Skipping tests.")
-        else:
-            invoke_lein(['with-profile', '+headless', 'check-and-exit'], jdk_path=jdk)
-            invoke_lein(['test'], jdk_path=jdk)
-            # test that docs can be successfully produced
-            write_docs('target/docs', jdk_path=jdk)
-        invoke_lein(['prerelease'], jdk_path=jdk)
-        create_bundle(jdk, platform, options)
+    # download and extract all JDKs concurrently in the background, while the editor is being built
+    executor = ThreadPoolExecutor(max_workers=len(options.target_platform))
+    try:
+        jdk_futures = [executor.submit(get_jdk, platform) for platform in options.target_platform]
+        for platform, jdk_future in zip(options.target_platform, jdk_futures):
+            log("Building editor for %s..." % platform)
+            jdk = jdk_future.result()
+            invoke_lein(init_command, jdk_path=jdk)
+            invoke_lein(['run', '-m', 'editor.ns-batch-builder', 'resources/sorted_clojure_ns_list.edn'], jdk_path=jdk)
+            if options.skip_tests:
+                log("Skipping tests.")
+            else:
+                invoke_lein(['with-profile', '+headless', 'check-and-exit'], jdk_path=jdk)
+                invoke_lein(['test'], jdk_path=jdk)
+                # test that docs can be successfully produced
+                write_docs('target/docs', jdk_path=jdk)
+            invoke_lein(['prerelease'], jdk_path=jdk)
+            create_bundle(jdk, platform, options)
+    finally:
+        # don't start any more downloads if the build fails
+        executor.shutdown(cancel_futures=True)
 
 if __name__ == '__main__':
     allowed_commands = {'build', 'docs'}
@@ -0,0 +1,60 @@
+# Copyright 2020-2026 The Defold Foundation
+# Copyright 2014-2020 King
+# Copyright 2009-2014 Ragnar Svensson, Christian Murray
+# Licensed under the Defold License version 1.0 (the "License"); you may not use
+# this file except in compliance with the License.
+#
+# You may obtain a copy of the License, together with FAQs at
+# https://www.defold.com/license
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os, sys, io, shutil, tarfile, tempfile, zipfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bundle
+import http_cache
+
+RELEASE = 'jdk-%s/release' % bundle.java_version
+
+def write_archive(path):
+    if '.zip' in os.path.basename(path):
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr(RELEASE, 'JAVA_VERSION')
+    else:
+        with tarfile.open(path, 'w:gz') as tf:
+            info = tarfile.TarInfo(RELEASE)
+            info.size = len(b'JAVA_VERSION')
+            tf.addfile(info, io.BytesIO(b'JAVA_VERSION'))
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = http_cache.Cache(self.root, 10**6)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check_extract(self, archive):
+        write_archive(archive)
+        out = os.path.join(self.root, 'out')
+        shutil.rmtree(out, ignore_errors=True)
+        os.makedirs(out)
+        bundle.extract(archive, out)
+        self.assertTrue(os.path.isfile(os.path.join(out, RELEASE)), archive)
+
+    def test_downloaded_jdk(self):
+        # the path http_cache.download() stores each JDK at
+        for platform in bundle.platform_to_java:
+            self.check_extract(self.cache._url_to_path(bundle.full_jdk_url(platform)))
+
+    def test_legacy_cache_entry(self):
+        # entries imported from the old cache layout keep their etag suffix
+        for platform in bundle.platform_to_java:
+            self.check_extract(self.cache._url_to_path(bundle.full_jdk_url(platform)) + '-' + b'"etag"'.hex())
+
+if __name__ == '__main__':
+    unittest.main()
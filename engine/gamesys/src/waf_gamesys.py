@@ -12,7 +12,7 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-import waflib.Task, waflib.TaskGen, waflib.Utils, re, os, sys
+import waflib.Task, waflib.TaskGen, waflib.Utils, re, os, sys, importlib, functools
 from waflib.TaskGen import extension
 from waf_content import proto_compile_task
 from threading import Lock
@@ -22,51 +22,107 @@ from google.protobuf import text_format
 
 stderr_lock = Lock()
 
+# Source to compiled extension for resources referenced from game objects
+COMPONENT_EXTS = {
+    '.camera':              '.camerac',
+    '.collectionproxy':     '.collectionproxyc',
+    '.collisionobject':     '.collisionobjectc',
+    '.particlefx':          '.particlefxc',
+    '.gui':                 '.guic',
+    '.model':               '.modelc',
+    '.animationset':        '.animationsetc',
+    '.script':              '.scriptc',
+    '.sound':               '.soundc',
+    '.factory':             '.factoryc',
+    '.collectionfactory':   '.collectionfactoryc',
+    '.label':               '.labelc',
+    '.light':               '.lightc',
+    '.sprite':              '.spritec',
+    '.tileset':             '.t.texturesetc',
+    '.tilesource':          '.t.texturesetc',
+    '.tilemap':             '.tilemapc',
+    '.tilegrid':            '.tilemapc',
+}
+
+COLLISION_SHAPE_EXTS = {
+    '.convexshape': '.convexshapec',
+    '.tilemap':     '.tilemapc',
+    '.tilegrid':    '.tilemapc',
+}
+
+TEXTURE_EXTS = {
+    '.png': '.texturec',
+    '.jpg': '.texturec',
+}
+
+TILESOURCE_EXTS = {
+    '.tileset':     '.t.texturesetc',
+    '.tilesource':  '.t.texturesetc',
+    '.atlas':       '.t.texturesetc',
+}
+
+def swap_ext(path, exts):
+    i = path.rfind('.')
+    if i < 0:
+        return path
+    ext = exts.get(path[i:])
+    return path if ext is None else path[:i] + ext
+
 def configure(conf):
     pass
 
+ddf_modules = {}
+def get_module(name):
+    # The ddf modules are generated by the build and can't be imported when
+    # this file is loaded, so they are imported on first use instead
+    mod = ddf_modules.get(name)
+    if mod is None:
+        mod = importlib.import_module(name)
+        ddf_modules[name] = mod
+    return mod
+
+@functools.lru_cache(maxsize=4096)
+def hash_string(value):
+    # Property and shape ids repeat a lot across a project
+    return get_module('dlib').dmHashBuffer64(value)
+
+def parse_floats(value):
+    return map(float, value.split(','))
+
+property_handlers = {}
+def get_property_handlers():
+    # Property type to (entries field, values field, value parser)
+    if not property_handlers:
+        gameobject_ddf_pb2 = get_module('gameobject_ddf_pb2')
+        property_handlers.update({
+            gameobject_ddf_pb2.PROPERTY_TYPE_NUMBER:  ('number_entries',  'float_values',  lambda v: (float(v),)),
+            gameobject_ddf_pb2.PROPERTY_TYPE_HASH:    ('hash_entries',    'hash_values',   lambda v: (hash_string(v),)),
+            gameobject_ddf_pb2.PROPERTY_TYPE_URL:     ('url_entries',     'string_values', lambda v: (v,)),
+            gameobject_ddf_pb2.PROPERTY_TYPE_VECTOR3: ('vector3_entries', 'float_values',  parse_floats),
+            gameobject_ddf_pb2.PROPERTY_TYPE_VECTOR4: ('vector4_entries', 'float_values',  parse_floats),
+            gameobject_ddf_pb2.PROPERTY_TYPE_QUAT:    ('quat_entries',    'float_values',  parse_floats),
+        })
+    return property_handlers
+
 def transform_properties(properties, out_properties):
+    handlers = get_property_handlers()
     for property in properties:
-        entry = None
-        if property.type == gameobject_ddf_pb2.PROPERTY_TYPE_NUMBER:
-            entry = out_properties.number_entries.add()
-            entry.index = len(out_properties.float_values)
-            out_properties.float_values.append(float(property.value))
-        elif property.type == gameobject_ddf_pb2.PROPERTY_TYPE_HASH:
-            entry = out_properties.hash_entries.add()
-            entry.index = len(out_properties.hash_values)
-            out_properties.hash_values.append(dlib.dmHashBuffer64(property.value))
-        elif property.type == gameobject_ddf_pb2.PROPERTY_TYPE_URL:
-            entry = out_properties.url_entries.add()
-            entry.index = len(out_properties.string_values)
-            out_properties.string_values.append(property.value)
-        elif property.type == gameobject_ddf_pb2.PROPERTY_TYPE_VECTOR3:
-            entry = out_properties.vector3_entries.add()
-            entry.index = len(out_properties.float_values)
-            out_properties.float_values.extend([float(v.strip()) for v in property.value.split(',')])
-        elif property.type == gameobject_ddf_pb2.PROPERTY_TYPE_VECTOR4:
-            entry = out_properties.vector4_entries.add()
-            entry.index = len(out_properties.float_values)
-            out_properties.float_values.extend([float(v.strip()) for v in property.value.split(',')])
-        elif property.type == gameobject_ddf_pb2.PROPERTY_TYPE_QUAT:
-            entry = out_properties.quat_entries.add()
-            entry.index = len(out_properties.float_values)
-            out_properties.float_values.extend([float(v.strip()) for v in property.value.split(',')])
-        else:
+        handler = handlers.get(property.type)
+        if handler is None:
             raise Exception("Invalid type")
+        entries_name, values_name, parse = handler
+        entry = getattr(out_properties, entries_name).add()
+        values = getattr(out_properties, values_name)
+        entry.index = len(values)
+        values.extend(parse(property.value))
         entry.key = property.id
-        entry.id = dlib.dmHashBuffer64(property.id)
+        entry.id = hash_string(property.id)
 
 def transform_texture_name(task, name):
-    name = name.replace('.png', '.texturec')
-    name = name.replace('.jpg', '.texturec')
-    return name
+    return swap_ext(name, TEXTURE_EXTS)
 
 def transform_tilesource_name(name):
-    name = name.replace('.tileset', '.t.texturesetc')
-    name = name.replace('.tilesource', '.t.texturesetc')
-    name = name.replace('.atlas', '.t.texturesetc')
-    return name
+    return swap_ext(name, TILESOURCE_EXTS)
 
 def transform_collection(task, msg):
     for i in msg.instances:
@@ -82,11 +138,23 @@ def transform_collectionproxy(task, msg):
     msg.collection = msg.collection.replace('.collection', '.collectionc')
     return msg
 
+# Parsed convex shapes by path, as (mtime, message). The messages are shared
+# between collision objects and must not be modified
+convex_shapes = {}
+def load_convex_shape(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = convex_shapes.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    convex_msg = get_module('physics_ddf_pb2').ConvexShape()
+    with open(path, 'rb') as in_f:
+        text_format.Merge(in_f.read(), convex_msg)
+    convex_shapes[path] = (mtime, convex_msg)
+    return convex_msg
+
 def transform_collisionobject(task, msg):
-    import physics_ddf_pb2
-    import google.protobuf.text_format
-    import ddf.ddf_math_pb2
-    import dlib
+    physics_ddf_pb2 = get_module('physics_ddf_pb2')
     if msg.type != physics_ddf_pb2.COLLISION_OBJECT_TYPE_DYNAMIC:
         msg.mass = 0
 
@@ -94,28 +162,23 @@ def transform_collisionobject(task, msg):
     # NOTE: Special case for tilegrid resources. They are left as is
     if msg.collision_shape and not (msg.collision_shape.endswith('.tilegrid') or msg.collision_shape.endswith('.tilemap')):
         p = os.path.join(task.generator.content_root, msg.collision_shape[1:])
-        convex_msg = physics_ddf_pb2.ConvexShape()
-        with open(p, 'rb') as in_f:
-            google.protobuf.text_format.Merge(in_f.read(), convex_msg)
-            shape = msg.embedded_collision_shape.shapes.add()
-            shape.shape_type = convex_msg.shape_type
-            shape.position.x = shape.position.y = shape.position.z = 0
-            shape.rotation.x = shape.rotation.y = shape.rotation.z = 0
-            shape.rotation.w = 1
-            shape.index = len(msg.embedded_collision_shape.data)
-            shape.count = len(convex_msg.data)
-
-            for x in convex_msg.data:
-                msg.embedded_collision_shape.data.append(x)
+        convex_msg = load_convex_shape(p)
+        shape = msg.embedded_collision_shape.shapes.add()
+        shape.shape_type = convex_msg.shape_type
+        shape.position.x = shape.position.y = shape.position.z = 0
+        shape.rotation.x = shape.rotation.y = shape.rotation.z = 0
+        shape.rotation.w = 1
+        shape.index = len(msg.embedded_collision_shape.data)
+        shape.count = len(convex_msg.data)
+
+        msg.embedded_collision_shape.data.extend(convex_msg.data)
 
         msg.collision_shape = ''
 
     for x in msg.embedded_collision_shape.shapes:
-        x.id_hash = dlib.dmHashBuffer64(x.id)
+        x.id_hash = hash_string(x.id)
 
-    msg.collision_shape = msg.collision_shape.replace('.convexshape', '.convexshapec')
-    msg.collision_shape = msg.collision_shape.replace('.tilemap', '.tilemapc')
-    msg.collision_shape = msg.collision_shape.replace('.tilegrid', '.tilemapc')
+    msg.collision_shape = swap_ext(msg.collision_shape, COLLISION_SHAPE_EXTS)
     return msg
 
 def transform_particlefx(task, msg):
@@ -126,24 +189,7 @@ def transform_particlefx(task, msg):
 
 def transform_gameobject(task, msg):
     for c in msg.components:
-        c.component = c.component.replace('.camera', '.camerac')
-        c.component = c.component.replace('.collectionproxy', '.collectionproxyc')
-        c.component = c.component.replace('.collisionobject', '.collisionobjectc')
-        c.component = c.component.replace('.particlefx', '.particlefxc')
-        c.component = c.component.replace('.gui', '.guic')
-        c.component = c.component.replace('.model', '.modelc')
-        c.component = c.component.replace('.animationset', '.animationsetc')
-        c.component = c.component.replace('.script', '.scriptc')
-        c.component = c.component.replace('.sound', '.soundc')
-        c.component = c.component.replace('.factory', '.factoryc')
-        c.component = c.component.replace('.collectionfactory', '.collectionfactoryc')
-        c.component = c.component.replace('.label', '.labelc')
-        c.component = c.component.replace('.light', '.lightc')
-        c.component = c.component.replace('.sprite', '.spritec')
-        c.component = c.component.replace('.tileset', '.t.texturesetc')
-        c.component = c.component.replace('.tilesource', '.t.texturesetc')
-        c.component = c.component.replace('.tilemap', '.tilemapc')
-        c.component = c.component.replace('.tilegrid', '.tilemapc')
+        c.component = swap_ext(c.component, COMPONENT_EXTS)
 
         transform_properties(c.properties, c.property_decls)
     return msg
@@ -308,12 +354,12 @@ def transform_collectionfactory(task, msg):
     return msg
 
 def transform_render(task, msg):
-    import render.render_ddf_pb2
+    render_ddf_pb2 = get_module('render.render_ddf_pb2')
     msg.script = msg.script.replace('.render_script', '.render_scriptc')
 
     # Migrate from the old format to the new format for render prototypes
     for m in msg.materials:
-        entry = render.render_ddf_pb2.RenderPrototypeDesc.RenderResourceDesc()
+        entry = render_ddf_pb2.RenderPrototypeDesc.RenderResourceDesc()
         entry.name = m.name
         entry.path = m.material
         msg.render_resources.append(entry)
@@ -330,7 +376,7 @@ def transform_render_target(task, msg):
     return msg
 
 def transform_sprite(task, msg):
-    import sprite_ddf_pb2
+    sprite_ddf_pb2 = get_module('sprite_ddf_pb2')
 
     msg.material = msg.material.replace('.material', '.materialc')
     if msg.tile_set:
@@ -531,44 +577,31 @@ new_copy_task('copy prebuilt bufferc', '.prebuilt_bufferc', '.bufferc')
 # Copy raw data
 new_copy_task('copy raw data', '.raw', '.rawc')
 
-from io import StringIO
+# Strip single line comments but preserve "pure" multi-line comments
+# Note that ---[[ is a single line comment
+# You can enable a block in Lua by adding a hyphen, e.g.
+#
+# ---[[
+# The block is enabled
+# --]]
+#
+LUA_SINGLE_COMMENT_RE = re.compile('^[^\\S\\n]*--(?!\\[\\[|\\]\\]).*$', re.MULTILINE)
+LUA_MULTI_COMMENT_RE = re.compile('--\\[\\[.*?--\\]\\]', re.MULTILINE | re.DOTALL)
+LUA_REQUIRE_RE = re.compile('^[^\\S\\n]*require[^\\S\\n]*?(?:"(.*?)"|\\([^\\S\\n]*?"(.*?)"[^\\S\\n]*?\\))[^\\S\\n]*$', re.MULTILINE)
+
 def strip_single_lua_comments(str):
-    str = str.decode('utf-8').replace("\r", "");
-    sb = StringIO()
-    for line in str.split('\n'):
-        lineTrimmed = line.strip()
-        # Strip single line comments but preserve "pure" multi-line comments
-        # Note that ---[[ is a single line comment
-        # You can enable a block in Lua by adding a hyphen, e.g.
-        #
-        # ---[[
-        # The block is enabled
-        # --]]
-        #
-
-        if not lineTrimmed.startswith("--") or lineTrimmed.startswith("--[[") or lineTrimmed.startswith("--]]"):
-            sb.write(line)
-        sb.write("\n")
-    return sb.getvalue()
+    str = str.decode('utf-8').replace("\r", "")
+    return LUA_SINGLE_COMMENT_RE.sub('', str)
 
 def scan_lua(str):
     str = strip_single_lua_comments(str)
-    ptr = re.compile('--\\[\\[.*?--\\]\\]', re.MULTILINE | re.DOTALL)
     # NOTE: We don't preserve line-numbers
     # '' could be replaced with a function
-    str = ptr.sub('', str)
+    str = LUA_MULTI_COMMENT_RE.sub('', str)
 
     modules = []
-    rp1 = re.compile("require\\s*?\"(.*?)\"$")
-    rp2 = re.compile("require\\s*?\\(\\s*?\"(.*?)\"\\s*?\\)$")
-    for line in str.split('\n'):
-        line = line.strip()
-        m1 = rp1.match(line)
-        m2 = rp2.match(line)
-        if m1:
-            modules.append(m1.group(1))
-        elif m2:
-            modules.append(m2.group(1))
+    for m in LUA_REQUIRE_RE.finditer(str):
+        modules.append(m.group(1) if m.group(1) is not None else m.group(2))
     return modules
 
 def compile_lua(task):
@@ -581,9 +614,8 @@ def compile_lua(task):
 
         # Making the file name path relative to the source folder
         if hasattr(task.generator, "source_root"):
-            base = os.path.abspath(task.generator.source_root)
-            p = os.path.abspath(task.outputs[0].abspath())
-            p = os.path.relpath(p, base)
+            # NOTE: relpath makes both paths absolute itself
+            p = os.path.relpath(task.outputs[0].abspath(), task.generator.source_root)
             # Keep the suffix
             lua_module.source.filename = os.path.splitext(p)[0] + os.path.splitext(task.inputs[0].srcpath())[1]
         else:
@@ -15,6 +15,7 @@ import argparse
 import csv
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.join(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')), "build_tools"))
 import github
@@ -89,6 +90,26 @@ def get_project_fields(token, project_id):
     return field_map
 
 
+BASE_COLS = [
+    "project_item_id",
+    "item_type",
+    "title",
+    "url",
+    "state",
+    "repo",
+    "number",
+    "author",
+    "assignees",
+    "labels",
+    "milestone",
+    "milestone_due",
+    "created_at",
+    "updated_at",
+    "closed_at",
+    "merged_at",
+]
+
+
 def normalize_field_value(field_value):
     """
     Converts ProjectV2ItemFieldValue union into a CSV-friendly primitive.
@@ -113,10 +134,17 @@ def normalize_field_value(field_value):
     return None
 
 
-def fetch_project_items(token, project_id, field_map):
+def get_columns(field_map):
     """
-    Fetch all items and return (rows, custom_field_names).
-    Each row includes base columns + one key per custom field name.
+    Returns the CSV columns: base columns + one per custom field name.
+    """
+    return BASE_COLS + sorted(set(field_map.values()))
+
+
+def iter_project_items(token, project_id, field_map, columns):
+    """
+    Fetch all items, yielding one row per item as it is received.
+    Each row is a list of values in the order given by `columns`.
     """
     query = """
     query {
@@ -189,131 +217,117 @@ def fetch_project_items(token, project_id, field_map):
     }
     """
 
-    base_cols = [
-        "project_item_id",
-        "item_type",
-        "title",
-        "url",
-        "state",
-        "repo",
-        "number",
-        "author",
-        "assignees",
-        "labels",
-        "milestone",
-        "milestone_due",
-        "created_at",
-        "updated_at",
-        "closed_at",
-        "merged_at",
-    ]
-
-    all_rows = []
-    custom_names = set(field_map.values())
-
-    after = None
-    while True:
-        data = graphql(token, query % ( project_id, ("\"" + after + "\"") if after else "null"))
-        items = data["node"]["items"]
-
-        for item in items["nodes"]:
-            row = {c: "" for c in base_cols}
-            # initialize custom fields
-            for cname in custom_names:
-                row[cname] = ""
-
-            row["project_item_id"] = item.get("id", "")
-            row["created_at"] = item.get("createdAt", "")
-            row["updated_at"] = item.get("updatedAt", "")
-
-            content = item.get("content")
-            if content:
-                ctype = content.get("__typename", "")
-                row["item_type"] = ctype
-
-                if ctype == "Issue":
-                    row["title"] = content.get("title", "")
-                    row["url"] = content.get("url", "")
-                    row["state"] = content.get("state", "")
-                    row["repo"] = (content.get("repository") or {}).get("nameWithOwner", "")
-                    row["number"] = content.get("number", "")
-                    row["author"] = (content.get("author") or {}).get("login", "")
-                    row["assignees"] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
-                    row["labels"] = ",".join([n["name"] for n in (content.get("labels") or {}).get("nodes", []) if n.get("name")])
-                    ms = content.get("milestone")
-                    if ms:
-                        row["milestone"] = ms.get("title", "")
-                        row["milestone_due"] = ms.get("dueOn", "") or ""
-                    row["closed_at"] = content.get("closedAt", "") or ""
-
-                elif ctype == "PullRequest":
-                    row["title"] = content.get("title", "")
-                    row["url"] = content.get("url", "")
-                    row["state"] = content.get("state", "")
-                    row["repo"] = (content.get("repository") or {}).get("nameWithOwner", "")
-                    row["number"] = content.get("number", "")
-                    row["author"] = (content.get("author") or {}).get("login", "")
-                    row["assignees"] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
-                    row["labels"] = ",".join([n["name"] for n in (content.get("labels") or {}).get("nodes", []) if n.get("name")])
-                    ms = content.get("milestone")
-                    if ms:
-                        row["milestone"] = ms.get("title", "")
-                        row["milestone_due"] = ms.get("dueOn", "") or ""
-                    row["closed_at"] = content.get("closedAt", "") or ""
-                    row["merged_at"] = content.get("mergedAt", "") or ""
-
-                elif ctype == "DraftIssue":
-                    row["title"] = content.get("title", "")
-                    # Draft issues don't have a canonical URL
-                    row["url"] = ""
-                    row["state"] = "DRAFT"
-                    row["repo"] = ""
-                    row["number"] = ""
-                    row["author"] = ""
-                    row["assignees"] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
-                    row["labels"] = ""
-                    row["milestone"] = ""
-                    row["milestone_due"] = ""
-                    row["closed_at"] = ""
-                    row["merged_at"] = ""
-
-            # Custom fields: map by field name
-            fv_nodes = (item.get("fieldValues") or {}).get("nodes", [])
-            for fv in fv_nodes:
-                field = fv.get("field") or {}
-                fname = field.get("name")
-                if not fname:
-                    # sometimes only id is available, fall back to field_map
-                    fid = field.get("id")
-                    fname = field_map.get(fid) if fid else None
-                if fname:
-                    row[fname] = normalize_field_value(fv) or ""
-
-            all_rows.append(row)
-
-        if not items["pageInfo"]["hasNextPage"]:
-            break
-        after = items["pageInfo"]["endCursor"]
+    col = {name: i for i, name in enumerate(BASE_COLS)}
+    custom_col = {name: i for i, name in enumerate(columns) if i >= len(BASE_COLS)}
 
-    # final column order
-    custom_field_cols = sorted(custom_names)
-    columns = base_cols + custom_field_cols
-    return all_rows, columns
+    def fetch_page(after):
+        data = graphql(token, query % (project_id, ("\"" + after + "\"") if after else "null"))
+        return data["node"]["items"]
+
+    # Request the next page as soon as its cursor is known, so the
+    # round-trip overlaps with processing the current page
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        next_page = executor.submit(fetch_page, None)
+        while next_page:
+            items = next_page.result()
+            next_page = None
+            if items["pageInfo"]["hasNextPage"]:
+                next_page = executor.submit(fetch_page, items["pageInfo"]["endCursor"])
+
+            for item in items["nodes"]:
+                row = [""] * len(columns)
+
+                row[col["project_item_id"]] = item.get("id", "")
+                row[col["created_at"]] = item.get("createdAt", "")
+                row[col["updated_at"]] = item.get("updatedAt", "")
+
+                content = item.get("content")
+                if content:
+                    ctype = content.get("__typename", "")
+                    row[col["item_type"]] = ctype
+
+                    if ctype == "Issue":
+                        row[col["title"]] = content.get("title", "")
+                        row[col["url"]] = content.get("url", "")
+                        row[col["state"]] = content.get("state", "")
+                        row[col["repo"]] = (content.get("repository") or {}).get("nameWithOwner", "")
+                        row[col["number"]] = content.get("number", "")
+                        row[col["author"]] = (content.get("author") or {}).get("login", "")
+                        row[col["assignees"]] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
+                        row[col["labels"]] = ",".join([n["name"] for n in (content.get("labels") or {}).get("nodes", []) if n.get("name")])
+                        ms = content.get("milestone")
+                        if ms:
+                            row[col["milestone"]] = ms.get("title", "")
+                            row[col["milestone_due"]] = ms.get("dueOn", "") or ""
+                        row[col["closed_at"]] = content.get("closedAt", "") or ""
+
+                    elif ctype == "PullRequest":
+                        row[col["title"]] = content.get("title", "")
+                        row[col["url"]] = content.get("url", "")
+                        row[col["state"]] = content.get("state", "")
+                        row[col["repo"]] = (content.get("repository") or {}).get("nameWithOwner", "")
+                        row[col["number"]] = content.get("number", "")
+                        row[col["author"]] = (content.get("author") or {}).get("login", "")
+                        row[col["assignees"]] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
+                        row[col["labels"]] = ",".join([n["name"] for n in (content.get("labels") or {}).get("nodes", []) if n.get("name")])
+                        ms = content.get("milestone")
+                        if ms:
+                            row[col["milestone"]] = ms.get("title", "")
+                            row[col["milestone_due"]] = ms.get("dueOn", "") or ""
+                        row[col["closed_at"]] = content.get("closedAt", "") or ""
+                        row[col["merged_at"]] = content.get("mergedAt", "") or ""
+
+                    elif ctype == "DraftIssue":
+                        row[col["title"]] = content.get("title", "")
+                        # Draft issues don't have a canonical URL
+                        row[col["url"]] = ""
+                        row[col["state"]] = "DRAFT"
+                        row[col["repo"]] = ""
+                        row[col["number"]] = ""
+                        row[col["author"]] = ""
+                        row[col["assignees"]] = ",".join([n["login"] for n in (content.get("assignees") or {}).get("nodes", []) if n.get("login")])
+                        row[col["labels"]] = ""
+                        row[col["milestone"]] = ""
+                        row[col["milestone_due"]] = ""
+                        row[col["closed_at"]] = ""
+                        row[col["merged_at"]] = ""
+
+                # Custom fields: map by field name
+                fv_nodes = (item.get("fieldValues") or {}).get("nodes", [])
+                for fv in fv_nodes:
+                    field = fv.get("field") or {}
+                    fname = field.get("name")
+                    if not fname:
+                        # sometimes only id is available, fall back to field_map
+                        fid = field.get("id")
+                        fname = field_map.get(fid) if fid else None
+                    if fname in custom_col:
+                        row[custom_col[fname]] = normalize_field_value(fv) or ""
+
+                yield row
+    finally:
+        # also when the rows aren't all consumed, don't leave a page request behind
+        executor.shutdown(cancel_futures=True)
 
 
 def write_csv(path, rows, columns):
+    """
+    Writes the header and then streams `rows` to the file. Returns the number of rows written.
+    """
+    count = 0
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
     with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
-        w.writeheader()
-        for r in rows:
-            # ensure all values are CSV-safe strings
-            out = {}
-            for k in columns:
-                v = r.get(k, "")
-                if v is None:
-                    v = ""
-                out[k] = v
-            w.writerow(out)
+        w = csv.writer(f)
+        w.writerow(columns)
+        # None values are written as empty strings
+        w.writerows(counted(rows))
+    return count
 
 
 def main():
@@ -325,10 +339,11 @@ def main():
 
     project_id = get_project_id(args.token, args.project)
     field_map = get_project_fields(args.token, project_id)
-    rows, columns = fetch_project_items(args.token, project_id, field_map)
+    columns = get_columns(field_map)
+    rows = iter_project_items(args.token, project_id, field_map, columns)
 
-    write_csv(args.out, rows, columns)
-    print("Wrote %d items to %s" % (len(rows), args.out))
+    count = write_csv(args.out, rows, columns)
+    print("Wrote %d items to %s" % (count, args.out))
     return 0
 
 
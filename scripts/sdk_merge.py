@@ -1,6 +1,9 @@
+import contextlib
 import os
+import re
 import shutil
 import tempfile
+import threading
 import zipfile
 from concurrent.futures import ThreadPoolExecutor
 
@@ -8,6 +11,11 @@ import s3
 
 
 DOWNLOAD_WORKERS = 4
+EXTRACT_WORKERS = 8
+COPY_BUFSIZE = 1024 * 1024
+
+# Absolute paths, or paths with a '..' component
+INVALID_ENTRY_PATH_RE = re.compile(r'^/|(?:^|/)\.\.(?:/|$)')
 
 
 def _download_platform_sdk_zip(netloc, key, out_path):
@@ -43,6 +51,27 @@ def download_platform_sdk_zips(netloc, base_prefix, platforms):
     return [(platform, tmp_paths[platform]) for platform in platforms]
 
 
+def _extract_zip_entries(zf, lock, entries, extract_dir):
+    # ZipFile serializes reads from the underlying file, so workers can share
+    # an open archive and still decompress concurrently. Opening and closing
+    # members updates an unguarded reference count, so those hold `lock`.
+    for out_dir in {os.path.dirname(os.path.join(extract_dir, filename)) for filename, _ in entries}:
+        os.makedirs(out_dir, exist_ok=True)
+    for filename, info in entries:
+        out_path = os.path.join(extract_dir, filename)
+        with lock:
+            src = zf.open(info, 'r')
+        try:
+            with open(out_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+        finally:
+            with lock:
+                src.close()
+        perm = (getattr(info, 'external_attr', 0) >> 16) & 0o7777
+        if perm:
+            os.chmod(out_path, perm)
+
+
 def merge_platform_sdk_zips_into_tree(platform_zips, extract_dir, canonical_platform='x86_64-linux'):
     """
     Merge multiple per-platform SDK zips into `extract_dir` by selecting a single source zip per output path.
@@ -56,36 +85,40 @@ def merge_platform_sdk_zips_into_tree(platform_zips, extract_dir, canonical_plat
     ordered_platform_zips = [(canonical_platform, platform_to_zip[canonical_platform])]
     ordered_platform_zips.extend([(p, z) for p, z in platform_zips if p != canonical_platform])
 
-    selected_by_path = {}  # filename -> (zip_path, platform)
-    for platform, zip_path in ordered_platform_zips:
-        with zipfile.ZipFile(zip_path, 'r') as zf:
+    with contextlib.ExitStack() as stack:
+        # Each zip is opened once and used for both selection and extraction
+        open_zips = {}  # zip_path -> ZipFile
+        selected_by_path = {}  # filename -> (zip_path, info)
+        for platform, zip_path in ordered_platform_zips:
+            zf = stack.enter_context(zipfile.ZipFile(zip_path, 'r'))
+            open_zips[zip_path] = zf
             for info in zf.infolist():
                 name = info.filename.replace('\\', '/')
-                if not name or name.startswith('/') or '..' in name.split('/'):
+                if not name or INVALID_ENTRY_PATH_RE.search(name):
                     raise Exception(f"Invalid zip entry path in {platform}: {info.filename}")
-                if bool(getattr(info, 'is_dir', lambda: name.endswith('/'))()):
+                if name.endswith('/'):
                     continue
 
                 if name not in selected_by_path:
-                    selected_by_path[name] = (zip_path, platform)
-
-    extract_map = {}  # zip_path -> [filename...]
-    for filename, (zip_path, _) in selected_by_path.items():
-        extract_map.setdefault(zip_path, []).append(filename)
-
-    for zip_path, filenames in extract_map.items():
-        with zipfile.ZipFile(zip_path, 'r') as zf:
-            for filename in sorted(filenames):
-                info = zf.getinfo(filename)
-                if getattr(info, 'is_dir', lambda: filename.endswith('/'))():
-                    continue
-                out_path = os.path.join(extract_dir, filename)
-                os.makedirs(os.path.dirname(out_path), exist_ok=True)
-                with zf.open(filename, 'r') as src, open(out_path, 'wb') as dst:
-                    shutil.copyfileobj(src, dst)
-                perm = (getattr(info, 'external_attr', 0) >> 16) & 0o7777
-                if perm:
-                    os.chmod(out_path, perm)
+                    selected_by_path[name] = (zip_path, info)
+
+        extract_map = {}  # zip_path -> [(filename, info)...]
+        for filename, (zip_path, info) in selected_by_path.items():
+            extract_map.setdefault(zip_path, []).append((filename, info))
+
+        # Most files come from the canonical zip, so split each zip's files into
+        # slices for the workers.
+        jobs = []
+        for zip_path, entries in extract_map.items():
+            entries.sort(key=lambda entry: entry[0])
+            step = max(1, -(-len(entries) // EXTRACT_WORKERS))
+            lock = threading.Lock()
+            jobs.extend((open_zips[zip_path], lock, entries[i:i + step]) for i in range(0, len(entries), step))
+
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as ex:
+            futures = [ex.submit(_extract_zip_entries, zf, lock, entries, extract_dir) for zf, lock, entries in jobs]
+            for f in futures:
+                f.result()
 
     print("Merged platform SDKs into", extract_dir)
 